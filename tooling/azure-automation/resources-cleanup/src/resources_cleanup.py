@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
 
 import automationassets
-from typing import List
+from typing import Dict, Iterable, Optional, TextIO
+import concurrent.futures
 import datetime
+import functools
+import io
+import logging
+import sys
 
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from azure.identity import DefaultAzureCredential
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.mgmt.resource import ResourceManagementClient
 from azure.mgmt.resource.resources.v2022_09_01.models._models_py3 import GenericResourceExpanded, ResourceGroup
 
@@ -16,147 +30,279 @@ from azure.mgmt.resource.resources.v2022_09_01.models._models_py3 import Generic
 DRY_RUN = True
 
 # VERBOSE is used to control whether to print all the resources of each resource group
-# for informational purposes.
+# for informational purposes. It sets the level of the logger to DEBUG.
 VERBOSE = False
 
 DEFAULT_API_VERSION = "2022-09-01"
 
+# Scope of the tokens used to call Azure Resource Manager.
+ARM_TOKEN_SCOPE = "https://management.azure.com/.default"
+
+# MAX_WORKERS is the number of resource groups processed concurrently. Processing is
+# dominated by ARM round trips, so threads overlap the network latency.
+MAX_WORKERS = 16
+
+# Printed after the output of each resource group.
+RESOURCE_GROUP_SEPARATOR = "_"*80 + "\n"
+
+# Resource groups older than MAX_RESOURCE_GROUP_AGE are deleted.
+MAX_RESOURCE_GROUP_AGE = datetime.timedelta(days=2)
+
+# Tag added by the ARO-CreatedAt policy with the creation time of the resource group.
+CREATED_AT_TAG = "createdAt"
+
+# Error code returned by ARM when a deny assignment prevents the deletion of a resource group.
+DENY_ASSIGNMENT_ERROR_CODE = "DenyAssignmentAuthorizationFailed"
+
+logger = logging.getLogger("resources_cleanup")
+
 
 def get_date_time_from_str(date_time_str: str)-> datetime.datetime:
     """ get_date_time_from_str expects an input date in ISO 8601 with Z suffix
     e,g: 2024-01-26T17:08:13.8139962Z
     In Python < 3.11, fromisoformat() does not accept Z suffix even if it is valid in
     ISO 8601 (https://discuss.python.org/t/parse-z-timezone-suffix-in-datetime/2220).
+    When the ciso8601 package is installed, it is used instead as it parses the Z suffix and
+    the fractional seconds natively. Dates without time zone are considered to be in UTC, so
+    both parsers always return an aware datetime.
     """
-    date_time_str = date_time_str.replace("Z", "").replace("z", "")
-    dot = "."
-    if dot in date_time_str:
-        dot_index = date_time_str.index(dot)
-        date_time_str = date_time_str[0:dot_index]
-    
-    utc_suffix = '+00:00'
-    date_time_str += utc_suffix
-    
-    return datetime.datetime.fromisoformat(date_time_str)
+    if ciso8601 != None:
+        date_time = ciso8601.parse_datetime(date_time_str)
+        if date_time.tzinfo == None:
+            date_time = date_time.replace(tzinfo=datetime.timezone.utc)
+        return date_time
+
+    if date_time_str[-1:] in ("Z", "z"):
+        date_time_str = date_time_str[:-1] + "+00:00"
+
+    # fromisoformat() before Python 3.11 only accepts 3 or 6 fractional digits, so the
+    # fractional seconds are dropped rather than truncated. The time zone after them is kept.
+    dot_index = date_time_str.find(".")
+    if dot_index != -1:
+        fraction_end = dot_index + 1
+        while fraction_end < len(date_time_str) and date_time_str[fraction_end] in "0123456789":
+            fraction_end += 1
+        if fraction_end == dot_index + 1:
+            raise ValueError(f"Invalid isoformat string: {date_time_str!r}")
+        date_time_str = date_time_str[:dot_index] + date_time_str[fraction_end:]
+
+    date_time = datetime.datetime.fromisoformat(date_time_str)
+    if date_time.tzinfo == None:
+        date_time = date_time.replace(tzinfo=datetime.timezone.utc)
+    return date_time
 
 
 def time_delta_greater_than_two_days(now: datetime.datetime, resource_group_creation_time: datetime.datetime):
     if now == None:
-        print("now time is None")
         return False
     
     if resource_group_creation_time == None:
         # We do not want to delete the resource group if it does not have a creation timestamp.
-        print("resource_group_creation_time is None")
         return False
     
-    time_delta = resource_group_creation_time - now
-    n_days = abs(time_delta.days)
-
-    return n_days > 2
+    # A creation time in the future is not considered old.
+    return now - resource_group_creation_time > MAX_RESOURCE_GROUP_AGE
 
 
-def print_resources(resource_list: List[GenericResourceExpanded]):
-    for resource in resource_list:
-        print(f"- name: {resource.name}")
-        print(f"    ID: {resource.id}")
-        print(f"    type: {resource.type}")
-        print(f"    created at: {resource.created_time}")
-        print(f"    changed at: {resource.changed_time}")
-        print(f"    tags: {resource.tags}\n")
+def print_resources(resources: Iterable[GenericResourceExpanded], out: TextIO) -> int:
+    n_resources = 0
+    for resource in resources:
+        n_resources += 1
+        out.write(
+            f"- name: {resource.name}\n"
+            f"    ID: {resource.id}\n"
+            f"    type: {resource.type}\n"
+            f"    created at: {resource.created_time}\n"
+            f"    changed at: {resource.changed_time}\n"
+            f"    tags: {resource.tags}\n\n"
+        )
+    return n_resources
 
 
 def resource_group_has_persist_tag_as_true(resource_group: ResourceGroup):
-    if resource_group.tags == None:
+    tags = resource_group.tags
+    if tags == None:
         return False
 
-    persist_tag = "persist"
-    if persist_tag not in resource_group.tags:
+    persist_tag_value = tags.get("persist")
+    if persist_tag_value == None:
         return False
 
-    return resource_group.tags[persist_tag].lower() == "true"
+    # The tag is usually lowercase already, in which case no lowercased copy is needed. Values
+    # of a different length cannot be "true" in any casing, so they are not lowercased either.
+    return persist_tag_value == "true" or (len(persist_tag_value) == 4 and persist_tag_value.lower() == "true")
 
 
 def process_resource_groups_of_subscription(subscription_id: str, resource_client: ResourceManagementClient):
-    resource_groups_list = list(resource_client.resource_groups.list())
-    n_resource_groups = len(resource_groups_list)
-    print(f"subscription {subscription_id} has {n_resource_groups} resource groups:\n")
+    logger.info("processing resource groups of subscription %s:\n", subscription_id)
+
+    # All the resource groups are compared against the same point in time.
+    now = datetime.datetime.now(datetime.timezone.utc)
 
-    for resource_group in resource_groups_list:
-        process_resource_group(resource_group, resource_client)
-        print("_"*80)
-        print()
+    n_resource_groups = 0
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pending = {}
+        try:
+            # Resource groups without a createdAt tag are never deleted, so ARM is asked to
+            # filter them out. The pager is consumed lazily, so the first resource groups are
+            # processed while the next pages are still being fetched.
+            for resource_group in resource_client.resource_groups.list(filter=f"tagName eq '{CREATED_AT_TAG}'"):
+                n_resource_groups += 1
+                future = executor.submit(process_resource_group, resource_group, resource_client, now)
+                pending[future] = resource_group.name
+                # Keep the workers busy while only holding a bounded number of resource groups
+                # whose output has not been written yet.
+                if len(pending) >= 2 * MAX_WORKERS:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    error = write_resource_group_outputs(done, pending)
+                    if error != None:
+                        break
+        except Exception as err:
+            error = err
 
+        if error != None:
+            # Stop at the first failure like a sequential run would: the resource groups
+            # that have not started yet are not processed.
+            for future in list(pending):
+                if future.cancel():
+                    logger.info("Resource group '%s' was not processed due to a previous error.", pending.pop(future))
 
-def process_resource_group(resource_group: ResourceGroup, resource_client: ResourceManagementClient):
+        # Every resource group that was processed gets its output written, even after a
+        # failure, so that no deletion goes unlogged.
+        remaining_error = write_resource_group_outputs(concurrent.futures.as_completed(list(pending)), pending)
+        if error == None:
+            error = remaining_error
+
+    if error != None:
+        raise error
+
+    logger.info("subscription %s has %d resource groups with a %s tag", subscription_id, n_resource_groups, CREATED_AT_TAG)
+
+
+def write_resource_group_outputs(futures: Iterable[concurrent.futures.Future], pending: Dict[concurrent.futures.Future, str]) -> Optional[Exception]:
+    """ write_resource_group_outputs logs the output of every future and removes it from
+    pending. A failed future does not stop the others from being logged; the first error
+    is returned instead of raised.
+    """
+    error = None
+    for future in futures:
+        resource_group_name = pending.pop(future)
+        try:
+            # The output of each resource group is buffered by its worker and written
+            # here at once, so the logs of concurrent resource groups do not interleave.
+            output = future.result()
+        except ResourceNotFoundError:
+            output = f"Resource group '{resource_group_name}' no longer exists, skipping.\n"
+        except Exception as err:
+            output = f"Resource group '{resource_group_name}' could not be processed: {err!r}\n"
+            if error == None:
+                error = err
+        logger.info("%s%s", output, RESOURCE_GROUP_SEPARATOR)
+    return error
+
+
+def process_resource_group(resource_group: ResourceGroup, resource_client: ResourceManagementClient, now: datetime.datetime) -> str:
+    out = io.StringIO()
     resource_group_name = resource_group.name
-    resource_list = list(
-        resource_client.resources.list_by_resource_group(resource_group_name, expand = "createdTime,changedTime")
-    )
     
-    print(f"Resource group '{resource_group_name}':")
-    print(f"Tags: {resource_group.tags}\n")
-    print(f"This resource group has {len(resource_list)} resources \n")
+    print(f"Resource group '{resource_group_name}':", file=out)
+    print(f"Tags: {resource_group.tags}\n", file=out)
     
-    if VERBOSE:
-        print_resources(resource_list)
+    # The resources of the resource group are only needed for informational purposes,
+    # so they are not listed at all unless debug logging is enabled.
+    if logger.isEnabledFor(logging.DEBUG):
+        resources = resource_client.resources.list_by_resource_group(resource_group_name, expand = "createdTime,changedTime")
+        n_resources = print_resources(resources, out)
+        print(f"This resource group has {n_resources} resources \n", file=out)
     
     if resource_group_has_persist_tag_as_true(resource_group):
-        print(f"Persist tag is true, this resource group should NOT be deleted, skipping.")
-        return
+        print(f"Persist tag is true, this resource group should NOT be deleted, skipping.", file=out)
+        return out.getvalue()
 
-    now = datetime.datetime.now(datetime.timezone.utc)
     resource_group_creation_time = get_creation_time_of_resource_group(resource_group)
     if not time_delta_greater_than_two_days(now, resource_group_creation_time):
-        print(f"This resource group should NOT be deleted, it is not older than two days, skipping.")
-        return
+        print(f"This resource group should NOT be deleted, it is not older than two days, skipping.", file=out)
+        return out.getvalue()
     
-    print("This resource group should be deleted.\n")
+    print("This resource group should be deleted.\n", file=out)
     if DRY_RUN:
-        return
+        return out.getvalue()
     
     try:
-        print("\nBeginning deletion of this resource group ...")
-        result_poller = resource_client.resource_groups.begin_delete(resource_group_name)
-        print(f"result_poller of resource group deletion: {result_poller}")
+        print("\nBeginning deletion of this resource group ...", file=out)
+        # The deletion is not waited for, so no polling thread is started for it.
+        result_poller = resource_client.resource_groups.begin_delete(resource_group_name, polling=False)
+        print(f"result_poller of resource group deletion: {result_poller}", file=out)
     except HttpResponseError as err:
-        target_error_code = "DenyAssignmentAuthorizationFailed"
-        if err.error.code == target_error_code:
-            print("skipping deletion of resource group due to deny assignment in the resource group")
+        if err.error.code == DENY_ASSIGNMENT_ERROR_CODE:
+            print("skipping deletion of resource group due to deny assignment in the resource group", file=out)
         else: 
             raise err
+
+    return out.getvalue()
             
     
 def get_creation_time_of_resource_group(resource_group):
-    resource_group_creation_time = None
-    created_at_tag = "createdAt"
-    if resource_group.tags != None and created_at_tag in resource_group.tags:
-        resource_group_creation_time = get_date_time_from_str(resource_group.tags[created_at_tag])
-    return resource_group_creation_time
+    tags = resource_group.tags
+    if tags == None or CREATED_AT_TAG not in tags:
+        return None
+    return get_date_time_from_str(tags[CREATED_AT_TAG])
+
+
+def get_http_transport() -> RequestsTransport:
+    """ get_http_transport returns a transport whose connection pool holds one connection per
+    worker. The default pool keeps 10 connections, so with more workers the extra connections
+    would be discarded after each request and the TCP and TLS handshakes repeated.
+    """
+    session = requests.Session()
+    # Retries are already handled by the retry policy of the Azure SDK pipeline.
+    adapter = HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=MAX_WORKERS,
+        max_retries=Retry(total=False, redirect=False, raise_on_status=False)
+    )
+    session.mount("https://", adapter)
+    return RequestsTransport(session=session)
 
 
 # https://learn.microsoft.com/en-us/azure/automation/shared-resources/variables?tabs=azure-powershell#python-functions-to-access-variables
+# Automation variables do not change during a Job, so they are only looked up once.
+@functools.lru_cache(maxsize=None)
 def get_subscription_id():
     return automationassets.get_automation_variable("subscription_id")
 
 
 def main():
+    # The Output tab of an Automation Job shows stdout; stderr is reported as errors.
+    # Only this logger is configured so the Azure SDK HTTP logs are not printed.
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if VERBOSE else logging.INFO)
+
     subscription_id = get_subscription_id()
 
+    # A single credential and client are shared by all the workers. The token is acquired
+    # before the resource groups are processed so that the workers find it already cached.
+    credential = DefaultAzureCredential()
+    credential.get_token(ARM_TOKEN_SCOPE)
+
     resource_client = ResourceManagementClient(
-        credential=DefaultAzureCredential(),
+        credential=credential,
         subscription_id=subscription_id,
-        api_version=DEFAULT_API_VERSION
+        api_version=DEFAULT_API_VERSION,
+        transport=get_http_transport()
     )
 
     runbook_name = 'Deletion Runbook'    
-    print(f"'{runbook_name} started'\n")
+    logger.info("'%s started'\n", runbook_name)
     
-    print(f"DRY_RUN flag is {DRY_RUN}\n")
-    print(f"VERBOSE flag is {VERBOSE}\n")
+    logger.info("DRY_RUN flag is %s\n", DRY_RUN)
+    logger.info("VERBOSE flag is %s\n", VERBOSE)
     
     process_resource_groups_of_subscription(subscription_id, resource_client)
-    print(f"\n'{runbook_name}' finished")
+    logger.info("\n'%s' finished", runbook_name)
 
 
 if __name__== "__main__":
@@ -1,71 +1,241 @@
+import automationassets
+import resources_cleanup
 from resources_cleanup import (
     resource_group_has_persist_tag_as_true, 
     time_delta_greater_than_two_days, 
-    get_date_time_from_str
+    get_date_time_from_str,
+    get_subscription_id,
+    process_resource_groups_of_subscription,
+    MAX_WORKERS
 )
 import datetime
-from collections import namedtuple
+import logging
 import pytest
+from azure.core.exceptions import ODataV4Format, ResourceNotFoundError
 from azure.mgmt.resource.resources.v2022_09_01.models._models_py3 import ResourceGroup
 
 
+def new_resource_group(tags, name=None):
+    # name is read-only in ResourceGroup: passing it to the constructor is ignored and logs
+    # a warning, so it is set afterwards as the SDK does when deserializing.
+    resource_group = ResourceGroup(location="test_location", tags=tags)
+    resource_group.name = name
+    return resource_group
+
+
 @pytest.mark.parametrize(
-    "input_resource_group,expected",
+    "tags,expected",
     [
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags=None), False),
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags={"persist": "false"}), False),
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags={"persist": "tru"}), False),
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags={"persist": ""}), False),
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags={"some_tag": "something"}), False),
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags={"persist": "TRUE"}), True),
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags={"persist": "truE"}), True),
-        (ResourceGroup(location="test_location", name="simple_resource_group", tags={"persist": "true"}), True),
+        (None, False),
+        ({"persist": "false"}, False),
+        ({"persist": "tru"}, False),
+        ({"persist": ""}, False),
+        ({"persist": "trues"}, False),
+        ({"persist": "fals"}, False),
+        ({"some_tag": "something"}, False),
+        ({"persist": "TRUE"}, True),
+        ({"persist": "truE"}, True),
+        ({"persist": "True"}, True),
+        ({"persist": "true"}, True),
     ]
 )
-def test_resource_group_has_persist_tag_as_true(input_resource_group, expected):
-    assert resource_group_has_persist_tag_as_true(input_resource_group) == expected
+def test_resource_group_has_persist_tag_as_true(tags, expected):
+    assert resource_group_has_persist_tag_as_true(new_resource_group(tags)) == expected
 
 
 @pytest.mark.parametrize(
-    "time1,time2,expected", 
+    "now,creation_time,expected", 
     [
-        (datetime.datetime(year=2024, month=1, day=22), datetime.datetime(year=2024, month=1, day=25), True),
-        (datetime.datetime(year=2024, month=1, day=23), datetime.datetime(year=2024, month=1, day=25), False),
+        (datetime.datetime(year=2024, month=1, day=25), datetime.datetime(year=2024, month=1, day=22), True),
+        (datetime.datetime(year=2024, month=1, day=25), datetime.datetime(year=2024, month=1, day=22, hour=23), True),
+        (datetime.datetime(year=2024, month=1, day=25), datetime.datetime(year=2024, month=1, day=23), False),
         (datetime.datetime(year=2024, month=1, day=25), datetime.datetime(year=2024, month=1, day=25), False),
+        (datetime.datetime(year=2024, month=1, day=22), datetime.datetime(year=2024, month=1, day=25), False),
+        (datetime.datetime(year=2024, month=1, day=25), None, False),
     ]
 )
-def test_time_delta_greater_than_two_days(time1, time2, expected):
-    assert time_delta_greater_than_two_days(time1,time2) == expected    
+def test_time_delta_greater_than_two_days(now, creation_time, expected):
+    assert time_delta_greater_than_two_days(now, creation_time) == expected    
     
 
-Expected_date = namedtuple("Expected_date", ["year", "month", "day", "hour", "minute", "second"])
+# get_date_time_from_str uses ciso8601 when it is installed and falls back to
+# datetime.fromisoformat otherwise, so the date tests run against both parsers.
+@pytest.fixture(params=["ciso8601", "fromisoformat"])
+def date_time_parser(request, monkeypatch):
+    if request.param == "ciso8601":
+        pytest.importorskip("ciso8601")
+    else:
+        monkeypatch.setattr(resources_cleanup, "ciso8601", None)
+
+
+EXPECTED_DATE = datetime.datetime(year=2023, month=12, day=7, hour=18, minute=3, second=19, tzinfo=datetime.timezone.utc)
 @pytest.mark.parametrize(
-    "date_time_str,expected", 
+    "date_time_str", 
     [
-        ("2023-12-07T18:03:19Z", Expected_date(year=2023, month=12, day=7, hour=18, minute=3, second=19)),
-        ("2023-12-07T18:03:19.3628069Z", Expected_date(year=2023, month=12, day=7, hour=18, minute=3, second=19)),
-        ("2023-12-07T18:03:19.3628069", Expected_date(year=2023, month=12, day=7, hour=18, minute=3, second=19)),
-        ("2023-12-07T18:03:19.362636584736578436729474369", Expected_date(year=2023, month=12, day=7, hour=18, minute=3, second=19)),
-        ("2023-12-07T18:03:19.362636584736578436729474369Z", Expected_date(year=2023, month=12, day=7, hour=18, minute=3, second=19)),
+        "2023-12-07T18:03:19Z",
+        "2023-12-07T18:03:19.3628069Z",
+        "2023-12-07T18:03:19.3628069",
+        "2023-12-07T18:03:19.362636584736578436729474369",
+        "2023-12-07T18:03:19.362636584736578436729474369Z",
     ]
 )
-def test_get_date_time_from_str(date_time_str, expected: Expected_date):
-    date_time = get_date_time_from_str(date_time_str)
-    assert date_time.year== expected.year
-    assert date_time.month== expected.month
-    assert date_time.day== expected.day
-    assert date_time.hour== expected.hour
-    assert date_time.minute == expected.minute
-    assert date_time.second == expected.second
+@pytest.mark.usefixtures("date_time_parser")
+def test_get_date_time_from_str(date_time_str):
+    # Only ciso8601 keeps the fractional seconds.
+    assert get_date_time_from_str(date_time_str).replace(microsecond=0) == EXPECTED_DATE
+
+
+@pytest.mark.parametrize("date_time_str", ["2023-12-07T18:03:19Z", "2023-12-07T18:03:19.3628069", "2023-12-07"])
+@pytest.mark.usefixtures("date_time_parser")
+def test_get_date_time_from_str_returns_utc_singleton(date_time_str):
+    assert get_date_time_from_str(date_time_str).tzinfo is datetime.timezone.utc
+
+
+@pytest.mark.parametrize(
+    "date_time_str",
+    [
+        "2023-12-07T18:03:19+05:00",
+        "2023-12-07T18:03:19.3628069+05:00",
+    ]
+)
+@pytest.mark.usefixtures("date_time_parser")
+def test_get_date_time_from_str_keeps_utc_offset(date_time_str):
+    expected = datetime.datetime(year=2023, month=12, day=7, hour=13, minute=3, second=19, tzinfo=datetime.timezone.utc)
+    assert get_date_time_from_str(date_time_str).replace(microsecond=0) == expected
+
 
+@pytest.mark.usefixtures("date_time_parser")
+def test_get_date_time_from_str_date_only():
+    expected = datetime.datetime(year=2023, month=12, day=7, tzinfo=datetime.timezone.utc)
+    assert get_date_time_from_str("2023-12-07") == expected
 
-def test_get_date_time_from_str_raises_error_if_input_is_invalid_before_milliseconds_part():
+
+@pytest.mark.parametrize(
+    "date_time_str",
+    [
+        "20_malformed_7T18:03:19",
+        "",
+        "2023-12-07T18:03:19.Z",
+        "2023-12-07T18:03:19ZZ",
+    ],
+    ids=["invalid_before_milliseconds_part", "empty", "empty_fractional_part", "double_z_suffix"]
+)
+@pytest.mark.usefixtures("date_time_parser")
+def test_get_date_time_from_str_raises_error_if_input_is_invalid(date_time_str):
     with pytest.raises(ValueError):
-        date_time_str = "20_malformed_7T18:03:19"
         get_date_time_from_str(date_time_str)
 
 
-def test_get_date_time_from_str_raises_error_if_input_is_empty():
+# automation_variables replaces the Automation variables with the returned dict.
+@pytest.fixture
+def automation_variables(monkeypatch):
+    variables = {}
+
+    def get_automation_variable(name):
+        if name not in variables:
+            raise LookupError("asset:" + name + " not found")
+        return variables[name]
+
+    monkeypatch.setattr(automationassets, "get_automation_variable", get_automation_variable)
+    get_subscription_id.cache_clear()
+    yield variables
+    get_subscription_id.cache_clear()
+
+
+def test_get_subscription_id_is_looked_up_once(automation_variables):
+    automation_variables["subscription_id"] = "sub_id"
+    assert get_subscription_id() == "sub_id"
+
+    automation_variables["subscription_id"] = "other_sub_id"
+    assert get_subscription_id() == "sub_id"
+
+
+def test_get_subscription_id_raises_error_if_variable_is_missing(automation_variables):
+    with pytest.raises(LookupError):
+        get_subscription_id()
+
+
+class FakeResourceGroupsOperations:
+    def __init__(self, resource_groups, not_found=()):
+        self.resource_groups = resource_groups
+        self.not_found = set(not_found)
+        self.list_filter = None
+        self.deleted = []
+
+    def list(self, filter=None):
+        # A generator, like the SDK pager, so the resource groups are consumed lazily.
+        self.list_filter = filter
+        yield from self.resource_groups
+
+    def begin_delete(self, resource_group_name, polling=True):
+        if resource_group_name in self.not_found:
+            err = ResourceNotFoundError(f"Resource group '{resource_group_name}' could not be found.")
+            err.error = ODataV4Format({"error": {"code": "ResourceGroupNotFound", "message": str(err)}})
+            raise err
+        self.deleted.append(resource_group_name)
+        return resource_group_name
+
+
+class FakeResourceManagementClient:
+    def __init__(self, resource_groups_operations):
+        self.resource_groups = resource_groups_operations
+
+
+def new_old_resource_groups(n):
+    return [new_resource_group({"createdAt": "2020-01-01T00:00:00Z"}, name=f"rg{i}") for i in range(n)]
+
+
+def logged_resource_group_names(caplog):
+    return [
+        record.getMessage().split("'")[1]
+        for record in caplog.records
+        if record.getMessage().startswith("Resource group '")
+    ]
+
+
+@pytest.fixture
+def deletion_logs(monkeypatch, caplog):
+    monkeypatch.setattr(resources_cleanup, "DRY_RUN", False)
+    caplog.set_level(logging.INFO, logger="resources_cleanup")
+    return caplog
+
+
+def test_process_resource_groups_of_subscription_processes_each_resource_group_once(deletion_logs):
+    resource_groups = new_old_resource_groups(2 * MAX_WORKERS + 5)
+    operations = FakeResourceGroupsOperations(resource_groups)
+
+    process_resource_groups_of_subscription("sub_id", FakeResourceManagementClient(operations))
+
+    names = [resource_group.name for resource_group in resource_groups]
+    assert operations.list_filter == "tagName eq 'createdAt'"
+    assert sorted(operations.deleted) == sorted(names)
+    assert sorted(logged_resource_group_names(deletion_logs)) == sorted(names)
+    assert deletion_logs.records[-1].getMessage() == f"subscription sub_id has {len(names)} resource groups with a createdAt tag"
+
+
+def test_process_resource_groups_of_subscription_skips_resource_groups_that_no_longer_exist(deletion_logs):
+    resource_groups = new_old_resource_groups(3)
+    operations = FakeResourceGroupsOperations(resource_groups, not_found=["rg1"])
+
+    process_resource_groups_of_subscription("sub_id", FakeResourceManagementClient(operations))
+
+    assert sorted(operations.deleted) == ["rg0", "rg2"]
+    assert "Resource group 'rg1' no longer exists, skipping." in deletion_logs.text
+    assert sorted(logged_resource_group_names(deletion_logs)) == ["rg0", "rg1", "rg2"]
+
+
+def test_process_resource_groups_of_subscription_logs_other_resource_groups_when_one_fails(deletion_logs):
+    resource_groups = new_old_resource_groups(2 * MAX_WORKERS + 5)
+    resource_groups[3].tags = {"createdAt": "not_a_date"}
+    operations = FakeResourceGroupsOperations(resource_groups)
+
     with pytest.raises(ValueError):
-        date_time_str = ""
-        get_date_time_from_str(date_time_str)
\ No newline at end of file
+        process_resource_groups_of_subscription("sub_id", FakeResourceManagementClient(operations))
+
+    logged_names = logged_resource_group_names(deletion_logs)
+    assert "rg3" not in operations.deleted
+    assert "Resource group 'rg3' could not be processed" in deletion_logs.text
+    # Every deleted resource group is logged, and only once.
+    assert len(logged_names) == len(set(logged_names))
+    assert set(operations.deleted) <= set(logged_names)
+    assert "resource groups with a createdAt tag" not in deletion_logs.text